@@ -1,9 +1,10 @@
 # Author: Sebastian Romero
 
+import micropython
 from micropython import const
 from machine import Pin
-from time import sleep_ms
-import struct
+from time import sleep_ms, ticks_ms, ticks_add, ticks_diff
+import select
 
 # Macros
 DFPLAYER_BOOTUP_TIME_MS = const(3000)  # Boot up of the device takes 1.5 to 3 secs.
@@ -134,87 +135,249 @@ class PlaybackSource:
     SLEEP = 3
     FLASH = 4
 
+# Lookup tables used to dispatch response codes with a single dict lookup
+# instead of an if/elif cascade.
+_ERRORS = {
+    DFPLAYER_ERROR_BUSY: "DFPlayer is busy",
+    DFPLAYER_ERROR_FRAME: "DFPlayer received incomplete frame",
+    DFPLAYER_ERROR_FCS: "DFPlayer received corrupted frame (FCS mismatch)",
+    DFPLAYER_ERROR_NO_SUCH_FILE: "No such file or folder",
+}
+_STATUSES = {
+    DFPLAYER_STATUS_STOPPED: PlayerStatus.STOPPED,
+    DFPLAYER_STATUS_PLAYING: PlayerStatus.PLAYING,
+    DFPLAYER_STATUS_PAUSED: PlayerStatus.PAUSED,
+}
+
+@micropython.viper
+def _checksum(command: int, data_high: int, data_low: int) -> int:
+    """Frame check sequence over version, length, command, ack and data bytes."""
+    return -(0xFF + 0x06 + command + 0x01 + data_high + data_low) & 0xFFFF
+
+# Scratch buffers shared by all DFPlayer instances. _send_command is strictly
+# synchronous (write, wait, read), so sharing is safe on MicroPython's
+# single-threaded ports; the driver is not reentrant across threads.
+_TX_FRAME = bytearray(b'\x7e\xff\x06\x00\x01\x00\x00\x00\x00\xef')
+_RX_BUF = bytearray(DFPLAYER_FRAME_SIZE)
+
+# File-count queries need extra settle time after the reply. Kept as a
+# module-level frozenset so the membership test allocates nothing per call.
+_QUERY_FILES_CMDS = frozenset((DFPLAYER_CMD_FILES_USB, DFPLAYER_CMD_FILES_SDCARD,
+                               DFPLAYER_CMD_FILES_FLASH, 0x4E))
+
+def _settle_time(command):
+    """Extra time in ms the device needs after a command before it will
+    accept the next one, beyond the reply itself."""
+    if command == DFPLAYER_CMD_SET_SOURCE: # set_media
+        return 200
+    if command in _QUERY_FILES_CMDS: # query files
+        return 500
+    return 0
+
+def _build_frame(command, data_high = 0x0, data_low = 0x0):
+    """Build a complete command frame as an immutable bytes object."""
+    checksum = _checksum(command, data_high, data_low)
+    return bytes((DFPLAYER_START, DFPLAYER_VERSION, DFPLAYER_LEN, command, DFPLAYER_ACK,
+                  data_high, data_low, checksum >> 8, checksum & 0xFF, DFPLAYER_END))
+
+# Frames for argument-less commands are constant, so build each of them once
+# at import time and let _send_command skip the checksum arithmetic for them.
+_FRAMES = {cmd: _build_frame(cmd) for cmd in (
+    DFPLAYER_CMD_NEXT, DFPLAYER_CMD_PREV, DFPLAYER_CMD_RESET, DFPLAYER_CMD_PLAY,
+    DFPLAYER_CMD_PAUSE, DFPLAYER_CMD_STANDBY_ENTER, DFPLAYER_CMD_STANDBY_EXIT,
+    DFPLAYER_CMD_GET_STATUS, DFPLAYER_CMD_GET_VOLUME, DFPLAYER_CMD_GET_EQUALIZER,
+    DFPLAYER_CMD_GET_MODE, DFPLAYER_CMD_GET_VERSION, DFPLAYER_CMD_FILES_USB,
+    DFPLAYER_CMD_FILES_SDCARD, DFPLAYER_CMD_FILES_FLASH, DFPLAYER_CMD_FILENO_USB,
+    DFPLAYER_CMD_FILENO_SDCARD, DFPLAYER_CMD_FILENO_FLASH,
+)}
+
 class DFPlayer:
     def __init__(self, uart, busy_pin = None):
         self.uart = uart
         uart.init(baudrate=DFPLAYER_BAUD, bits=DFPLAYER_DATA_BITS, parity=DFPLAYER_PARITY, stop=DFPLAYER_STOP_BITS, timeout=DFPLAYER_TIMEOUT_MS)
+        # Poll object to wait for incoming data instead of sleeping a fixed delay.
+        self._poll = select.poll()
+        self._poll.register(uart, select.POLLIN)
+        # Point in time at which the device is done booting after a reset.
+        self._reset_deadline = ticks_ms()
+        # Called with (code, data) for every event notification drained
+        # from the UART buffer, e.g. card inserted or track finished.
+        self.on_notify = None
         self.busy_pin = busy_pin
         if busy_pin:
             self.busy_pin.init(Pin.IN)
-            busy_pin.irq(trigger=Pin.IRQ_RISING | Pin.IRQ_FALLING, handler=self._on_busy_pin_change)
-
-    def _on_busy_pin_change(self, pin):
-         # High level during playback; Low in pause status and module sleep
-        self._playing = pin.value() == 0
 
     @property
     def playing(self):
         """Return True if the DFPlayer is currently playing a song."""
         if self.busy_pin: # If we have a busy pin, use it
-            return self._playing
+            # The pin is pulled low while a song is playing, so the state
+            # can be read directly without caching it in an IRQ handler.
+            return self.busy_pin.value() == 0
         return self.status == PlayerStatus.PLAYING
 
+    @micropython.native
     def _read_data(self):
         self.uart.flush() # Clear the buffer
 
         if not self.uart.any():
             return None, None
         
-        buf = self.uart.read(DFPLAYER_FRAME_SIZE)
-        if buf is None or len(buf) != DFPLAYER_FRAME_SIZE:
-            return None, None        
+        n = self.uart.readinto(_RX_BUF)
+        if n != DFPLAYER_FRAME_SIZE:
+            return None, None
+        buf = _RX_BUF
         
         if buf[0] == DFPLAYER_START and buf[1] == DFPLAYER_VERSION and buf[2] == DFPLAYER_LEN and buf[9] == DFPLAYER_END:
             cmd = buf[3]
-            data = struct.unpack('>H', buf[5:7])[0]
+            data = (buf[5] << 8) | buf[6]
             return (cmd, data)
         
         # TODO: Handle invalid frames
         #return None
         raise RuntimeError("Invalid frame received")
 
-    def _send_command(self, command, data_high = 0x0, data_low = 0x0):
+    def _drain(self):
+        """
+        Process every complete frame waiting in the UART buffer.
+        Event notifications (insert/eject/track done) are forwarded to the
+        on_notify callback as (code, data) pairs. The most recent command
+        response is returned as a (code, data) tuple, or (None, None) if
+        the buffer held no response. Call this periodically between
+        commands to receive notifications without blocking.
+        """
+        response_code, response_data = None, None
+        buf = _RX_BUF
+        while self.uart.any() >= DFPLAYER_FRAME_SIZE:
+            if self.uart.readinto(buf) != DFPLAYER_FRAME_SIZE:
+                break
+            if not (buf[0] == DFPLAYER_START and buf[1] == DFPLAYER_VERSION and buf[2] == DFPLAYER_LEN and buf[9] == DFPLAYER_END):
+                raise RuntimeError("Invalid frame received")
+            code = buf[3]
+            data = (buf[5] << 8) | buf[6]
+            if code & DFPLAYER_CLASS_MASK == DFPLAYER_CLASS_NOTIFY:
+                if self.on_notify:
+                    self.on_notify(code, data)
+            else:
+                response_code, response_data = code, data
+        return response_code, response_data
+
+    def _write_command(self, command, data_high = 0x0, data_low = 0x0):
         # Ensure command is only one byte long
         if command > 0xFF:
             raise ValueError("Command must be a single byte")
-        frame_check_init = -(DFPLAYER_VERSION + DFPLAYER_LEN)
-        checksum = frame_check_init - (command + DFPLAYER_ACK + data_low + data_high)
-        high_byte, low_byte = checksum >> 8, checksum & 0xFF
-        frame = [DFPLAYER_START, DFPLAYER_VERSION, DFPLAYER_LEN, command, DFPLAYER_ACK, data_high, data_low, high_byte, low_byte, DFPLAYER_END]        
-        frame = bytes([b & 0xFF for b in frame]) # Convert to unsigned bytes
-        self.uart.write(bytes(frame))
-        
-        # TODO extract into a method
-        # Give device some time to process the command
-        if command == DFPLAYER_CMD_SET_SOURCE: # set_media
-            sleep_ms(200)
-        elif command == DFPLAYER_CMD_RESET: # reset
-            sleep_ms(DFPLAYER_BOOTUP_TIME_MS)
-        elif command in [0x47,0x48,0x49,0x4E]:     # query files
-            sleep_ms(500)
+        if data_high == 0 and data_low == 0 and command in _FRAMES:
+            # Argument-less command; the frame was precomputed at import time.
+            self.uart.write(_FRAMES[command])
         else:
-            sleep_ms(DFPLAYER_SEND_DELAY_MS) # other commands
-        
-        response_code, response_data = self._read_data()
+            data_high &= 0xFF
+            data_low &= 0xFF
+            checksum = _checksum(command, data_high, data_low)
+            frame = _TX_FRAME
+            frame[3] = command
+            frame[5] = data_high
+            frame[6] = data_low
+            frame[7] = checksum >> 8
+            frame[8] = checksum & 0xFF
+            self.uart.write(frame)
+
+    def _handle_response(self, command, response_code, response_data):
+        if command == DFPLAYER_CMD_RESET:
+            # Don't block for the boot-up time; remember when the device
+            # will be ready and let the next command wait if necessary.
+            self._reset_deadline = ticks_add(ticks_ms(), DFPLAYER_BOOTUP_TIME_MS)
 
         if response_code == DFPLAYER_RESPONSE_OK:
             return True
         
         if response_code == DFPLAYER_RESPONSE_ERROR:
-            if response_data == DFPLAYER_ERROR_BUSY:
-                raise RuntimeError("DFPlayer is busy")
-            if response_data == DFPLAYER_ERROR_FRAME:
-                raise RuntimeError("DFPlayer received incomplete frame")
-            if response_data == DFPLAYER_ERROR_FCS:
-                raise RuntimeError("DFPlayer received corrupted frame (FCS mismatch)")
-            if response_data == DFPLAYER_ERROR_NO_SUCH_FILE:
-                raise RuntimeError("No such file or folder")
-            raise RuntimeError("Unknown error")          
-        
+            raise RuntimeError(_ERRORS.get(response_data, "Unknown error"))
+
+        # Query replies carry their data through to the caller.
+        return response_code, response_data
+
+    def _read_response(self):
+        # Wait for the reply instead of sleeping the worst-case delay.
+        # Returns as soon as data arrives, or after DFPLAYER_TIMEOUT_MS.
+        self._poll.poll(DFPLAYER_TIMEOUT_MS)
+        for attempt in range(DFPLAYER_RETRIES):
+            response_code, response_data = self._read_data()
+            if response_code is not None:
+                break
+            # Reply lost or late due to UART noise; back off briefly and
+            # retry, but don't sleep after the last attempt has failed.
+            if attempt < DFPLAYER_RETRIES - 1:
+                sleep_ms(5 << attempt)
+        return response_code, response_data
+
+    async def _read_response_async(self):
+        # Same synchronization as _read_response, but yields to other
+        # tasks instead of blocking while waiting.
+        import asyncio
+        deadline = ticks_add(ticks_ms(), DFPLAYER_TIMEOUT_MS)
+        while ticks_diff(deadline, ticks_ms()) > 0:
+            if self.uart.any() >= DFPLAYER_FRAME_SIZE:
+                break
+            await asyncio.sleep_ms(5)
+        for attempt in range(DFPLAYER_RETRIES):
+            response_code, response_data = self._read_data()
+            if response_code is not None:
+                break
+            if attempt < DFPLAYER_RETRIES - 1:
+                await asyncio.sleep_ms(5 << attempt)
+        return response_code, response_data
+
+    def _send_command(self, command, data_high = 0x0, data_low = 0x0):
+        # If a reset is still in flight, wait out the remaining boot time first.
+        remaining = ticks_diff(self._reset_deadline, ticks_ms())
+        if remaining > 0:
+            sleep_ms(remaining)
+        self._write_command(command, data_high, data_low)
+        response_code, response_data = self._read_response()
+        if response_code == DFPLAYER_RESPONSE_OK and command >= DFPLAYER_LOWEST_QUERY:
+            # Queries are acked first; the reply carrying the data follows
+            # in a separate frame that needs its own synchronized read.
+            response_code, response_data = self._read_response()
+        # Give the device some settle time after commands that need it,
+        # but only after the reply has already been read.
+        settle = _settle_time(command)
+        if settle:
+            sleep_ms(settle)
+        return self._handle_response(command, response_code, response_data)
+
+    async def _send_command_async(self, command, data_high = 0x0, data_low = 0x0):
+        """
+        Asyncio-friendly variant of _send_command.
+        Polls opportunistically against a ticks_ms deadline and yields to
+        other tasks while waiting for the reply instead of blocking the
+        whole scheduler.
+        """
+        import asyncio
+        remaining = ticks_diff(self._reset_deadline, ticks_ms())
+        if remaining > 0:
+            await asyncio.sleep_ms(remaining)
+        self._write_command(command, data_high, data_low)
+        response_code, response_data = await self._read_response_async()
+        if response_code == DFPLAYER_RESPONSE_OK and command >= DFPLAYER_LOWEST_QUERY:
+            response_code, response_data = await self._read_response_async()
+        settle = _settle_time(command)
+        if settle:
+            await asyncio.sleep_ms(settle)
+        return self._handle_response(command, response_code, response_data)
+
     def reset(self):
-        """Reset the DFPlayer."""
+        """
+        Reset the DFPlayer.
+        Returns immediately; use reset_complete() to check whether the
+        device has finished booting. Commands issued before that point
+        block for the remaining boot-up time.
+        """
         self._send_command(DFPLAYER_CMD_RESET)
 
+    def reset_complete(self):
+        """Return True once the device is done booting after a reset."""
+        return ticks_diff(ticks_ms(), self._reset_deadline) >= 0
+
     def next_track(self):
         self._send_command(DFPLAYER_CMD_NEXT)
     
@@ -230,8 +393,7 @@ class DFPlayer:
     @property
     def equalizer_mode(self):
         """Return the current equalizer setting."""
-        self._send_command(DFPLAYER_CMD_GET_EQUALIZER)
-        response_code, response_data = self._read_data()
+        response_code, response_data = self._send_command(DFPLAYER_CMD_GET_EQUALIZER)
         if response_code != DFPLAYER_CMD_GET_EQUALIZER:
             raise RuntimeError(f"Invalid response code received {response_code}")
         return response_data
@@ -239,7 +401,7 @@ class DFPlayer:
     @equalizer_mode.setter
     def equalizer_mode(self, value: EqualizerMode):
         """Set the equalizer mode."""
-        if value < 0 or value > 5:
+        if not 0 <= value <= 5:
             raise ValueError("Equalizer mode must be between 0 and 5")
         self._send_command(DFPLAYER_CMD_SET_EQUALIZER, 0x00, value)
 
@@ -251,8 +413,7 @@ class DFPlayer:
     
     @property
     def volume(self):
-        self._send_command(DFPLAYER_CMD_GET_VOLUME)
-        response_code, response_data = self._read_data()
+        response_code, response_data = self._send_command(DFPLAYER_CMD_GET_VOLUME)
         if response_code != DFPLAYER_CMD_GET_VOLUME:
             raise RuntimeError(f"Invalid response code received {response_code}")
         return int(response_data / DFPLAYER_MAX_VOLUME * 100)
@@ -260,22 +421,22 @@ class DFPlayer:
     @volume.setter
     def volume(self, value : int):
         """Set the volume of the DFPlayer in percent (0-100%)."""
-        if value < 0 or value > 100:
-            raise ValueError("Volume must be between 0 and 100")        
+        if not 0 <= value <= 100:
+            raise ValueError("Volume must be between 0 and 100")
         value = int(value / 100 * DFPLAYER_MAX_VOLUME) # Map to range 0 - 30
         self._send_command(DFPLAYER_CMD_SET_VOLUME, 0x00, value)
 
     def play_from_mp3_folder(self, track_number):
         """Play the given track number from the "MP3" folder."""
-        if track_number < 0 or track_number > DFPLAYER_MAX_MP3_FILE:
+        if not 0 <= track_number <= DFPLAYER_MAX_MP3_FILE:
             raise ValueError("Track number must be between 0 and 9999")
-        self._send_command(DFPLAYER_CMD_PLAY_FROM_MP3, track_number & 0xFF, track_number >> 8)
+        self._send_command(DFPLAYER_CMD_PLAY_FROM_MP3, track_number >> 8, track_number & 0xFF)
 
     def play_track(self, folder, track):
         """Play the given track number from the given folder."""
-        if folder < 0 or folder > DFPLAYER_MAX_FOLDER:
+        if not 0 <= folder <= DFPLAYER_MAX_FOLDER:
             raise ValueError("Folder number must be between 0 and 99")
-        if track < 0 or track > DFPLAYER_MAX_MP3_FILE:
+        if not 0 <= track <= DFPLAYER_MAX_MP3_FILE:
             raise ValueError("Track number must be between 0 and 9999")
         self._send_command(DFPLAYER_CMD_FILE, folder, track)
 
@@ -284,7 +445,7 @@ class DFPlayer:
         Set the playback mode (0 - 3). 
         0 = repeat, 1 = folder repeat, 2 = single repeat, 3 = random.
         """
-        if mode < 0 or mode > 1:
+        if not 0 <= mode <= 1:
             raise ValueError("Playback mode must be 0 or 1")
         self._send_command(DFPLAYER_CMD_SET_PLAYBACK_MODE, 0x00, mode)
 
@@ -293,7 +454,7 @@ class DFPlayer:
         Set the playback source.
         0 = U-disk, 1 = SD card, 2 = AUX, 3 = SLEEP, 4 = FLASH
         """
-        if source < 0 or source > 4:
+        if not 0 <= source <= 4:
             raise ValueError("Playback source must be between 0 and 4")
         self._send_command(DFPLAYER_CMD_SET_SOURCE, 0x00, source)
 
@@ -313,19 +474,16 @@ class DFPlayer:
         - PlayerStatus.PLAYING
         - PlayerStatus.PAUSED
         """
-        self._send_command(DFPLAYER_CMD_GET_STATUS)
-        response_code, response_data = self._read_data()
+        if self.busy_pin:
+            # The busy pin tells us instantly whether a song is playing,
+            # no UART round trip needed.
+            return PlayerStatus.PLAYING if self.playing else PlayerStatus.STOPPED
+
+        response_code, response_data = self._send_command(DFPLAYER_CMD_GET_STATUS)
         if response_code != DFPLAYER_CMD_GET_STATUS:
             raise RuntimeError(f"Invalid response code received {response_code}")
-        
-        if response_data == DFPLAYER_STATUS_STOPPED:
-            return PlayerStatus.STOPPED
-        if response_data == DFPLAYER_STATUS_PLAYING:
-            return PlayerStatus.PLAYING
-        if response_data == DFPLAYER_STATUS_PAUSED:
-            return PlayerStatus.PAUSED
-        
-        return None
+
+        return _STATUSES.get(response_data)
 
 if __name__ == "__main__":
     from machine import UART